@@ -0,0 +1,52 @@
+"""Output of batched remote commands (no SSH dependencies, so it can be unit tested on its own)."""
+
+BATCH_SENTINEL = '__RPI_BATCH_'  # Marks end of each command output in batched remote commands
+
+
+def batch_sentinel(index: int) -> str:
+    """Provide sentinel marking end of output of command with index in batch.
+
+    Returns:
+        Sentinel of the command.
+
+    """
+    return f'{BATCH_SENTINEL}{index}__'
+
+
+def split_batch_output(
+    stdout_output: str,
+    stderr_output: str,
+    command_count: int,
+    channel_status: int,
+) -> list[tuple[int | None, str, str]]:
+    """Split output of batched commands (see SshClient.run_batch) per command by the sentinels.
+
+    A command without its sentinel in the output has ended the shell (e.g. with "exit"), so it gets the exit status of
+    the channel. The commands after it have not been run, and they get None as exit status.
+
+    Args:
+        stdout_output: stdout of the batch.
+        stderr_output: stderr of the batch.
+        command_count: Number of commands in the batch.
+        channel_status: Exit status of the batch.
+
+    Returns:
+        Exit status (None if not run), stdout and stderr of each command.
+
+    """
+    results = []
+    shell_ended = False
+    for index in range(command_count):
+        if shell_ended:
+            results.append((None, '', ''))
+            continue
+        sentinel = batch_sentinel(index)
+        command_stdout, found, stdout_output = stdout_output.partition(f'{sentinel}=')
+        status, _, stdout_output = stdout_output.partition('\n')
+        command_stderr, _, stderr_output = stderr_output.partition(f'{sentinel}\n')
+        if found:
+            results.append((int(status), command_stdout, command_stderr))
+        else:
+            shell_ended = True
+            results.append((channel_status, command_stdout, command_stderr))
+    return results
@@ -1,23 +1,33 @@
 """Tool functions for RPI Remote control."""
 import argparse
+import codecs
 import configparser
 import enum
+import functools
 import json
+import selectors
 import sys
 import threading
 import time
-from dataclasses import dataclass, field
+import types
+from collections.abc import Mapping
+from dataclasses import dataclass, field, fields
 from pathlib import Path
-
-from pydantic import BaseModel, Field
+from typing import Self
 
 from .ssh_client import SshClient, SshClientHandler
 
 UPLOAD_EXCLUDES_FOLDERS = ['.venv', '.git', '.ruff_cache', '__pycache__']
 UPLOAD_EXCLUDES_FILES = []  # Add specific file names here if needed
 RPI_HOST_CONFIG_FILE = Path('rpi_host_config.yaml')
+LOCAL_PROJECTS_ROOT = (Path(__file__).parent / '..' / '..').resolve()  # Folder containing the local project directories
 RPI_SETTINGS_FILE = 'settings.ini'
 RPI_SETTINGS_FILE_SETTINGS_KEYWORD = 'settings'
+TMUX_STREAM_RECEIVE_SIZE = 65536  # Max bytes received from tmux log stream at a time
+TMUX_STREAM_WINDOW_SIZE = 4 * 1024 * 1024  # SSH channel window, so catching up on a big log is not stalled by window adjusts
+TMUX_STREAM_SELECT_TIMEOUT = 0.5  # Seconds waiting for tmux log data or user input before checking tmux session
+TMUX_CHECK_INTERVAL_MIN = 3.0  # Seconds until the first tmux session check while streaming
+TMUX_CHECK_INTERVAL_MAX = 30.0  # Max seconds between tmux session checks (interval doubles after each good check)
 
 
 class RpiRemoteCommandError(Exception):
@@ -36,21 +46,71 @@ class KillSignals(enum.StrEnum):
     SIGKILL = '-9'  # Force kill
 
 
-class _RpiSettings(BaseModel):
-    """Pydantic model for RPI settings."""
+@functools.cache
+def _config_field_types(config_class: type) -> dict[str, type]:
+    """Get field names and types of a configuration dataclass, looked up once per class.
+
+    Returns:
+        Type of each field name.
+
+    """
+    return {config_field.name: config_field.type for config_field in fields(config_class)}
+
+
+class _ValidatedConfig:
+    """Base of configuration dataclasses: validating field types and creating instances from dictionaries."""
+
+    __slots__ = ()
+
+    def __post_init__(self) -> None:
+        """Validate field types.
+
+        Raises:
+            TypeError: If a field value is not of the annotated type.
+
+        """
+        for name, field_type in _config_field_types(type(self)).items():
+            value = getattr(self, name)
+            if not isinstance(value, field_type):
+                error = f'{type(self).__name__}.{name} must be {field_type.__name__}: {value!r}'
+                raise TypeError(error)
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, object]) -> Self:
+        """Create configuration from dictionary, unknown keys are ignored.
+
+        Returns:
+            Configuration instance.
+
+        Raises:
+            ValueError: If a configuration value is missing.
+
+        """
+        field_names = _config_field_types(cls).keys()
+        if missing := [name for name in field_names if name not in data]:
+            error = f'Missing configuration values for {cls.__name__}: {", ".join(missing)}'
+            raise ValueError(error)
+        return cls(**{name: data[name] for name in field_names})
+
 
-    application_script: str = Field(..., description='The main application file to run on the RPI.')
-    tmux_session_name: str = Field(..., description='The tmux session name.')
-    tmux_log_path_pattern: str = Field(..., description='The log file path pattern for the tmux session.')
+@dataclass(slots=True, frozen=True)
+class _RpiSettings(_ValidatedConfig):
+    """RPI settings."""
 
+    application_script: str  # The main application file to run on the RPI
+    tmux_session_name: str  # The tmux session name
+    tmux_log_path_pattern: str  # The log file path pattern for the tmux session
+    tmux_log_path_search_pattern: str  # The log file path pattern with wildcard time stamp, for finding log files
 
-class RpiRemoteToolsConfig(BaseModel):
-    """Pydantic model for rpi-remote-tools configuration."""
 
-    project_directory: str = Field(..., description='The local project directory to sync to the RPI.')
-    local_project_path: Path = Field(..., description='The local path to sync to RPI.')
-    remote_project_folder: str = Field(..., description='The project path on the RPI.')
-    rpi_settings: _RpiSettings = Field(..., description='Setting for the application to be located on RPI.')
+@dataclass(slots=True, frozen=True)
+class RpiRemoteToolsConfig(_ValidatedConfig):
+    """rpi-remote-tools configuration."""
+
+    project_directory: str  # The local project directory to sync to the RPI
+    local_project_path: Path  # The local path to sync to RPI
+    remote_project_folder: str  # The project path on the RPI
+    rpi_settings: _RpiSettings  # Setting for the application to be located on RPI
 
 
 @dataclass
@@ -60,103 +120,165 @@ class RpiCommand:
     ssh_client: SshClient
     project_directory: str
     status: int = field(init=False)
-    stdout: list[str] = field(default_factory=list)
-    stderr: list[str] = field(default_factory=list)
+    stdout: str = ''
+    stderr: str = ''
+    _command_prefix: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        """Build the command line prefix, changing to the project folder on RPI, once."""
+        self._command_prefix = f'cd /home/{self.ssh_client.username}/{self.project_directory} && '
 
     def command(self, command: str, *, print_stdout: bool = True, ignore_stderr: bool = False) -> int:
         print(f'== Remote command to RPI: {command}')
-        command_line = f'cd /home/{self.ssh_client.username}/{self.project_directory} && {command}'
-        _stdin, stdout, stderr = self.ssh_client.client.exec_command(command_line)
-        self.status = stdout.channel.recv_exit_status()
-        self.stdout = stdout.read().decode('utf-8').rstrip().split('\n')
-        self.stderr = stderr.read().decode('utf-8').rstrip().split('\n')
-        if print_stdout and self.stdout[0]:
-            print(f'{"\n".join(self.stdout)}')
-        if self.stderr[0]:
-            if not ignore_stderr:
-                error = f'{"\n".join(self.stderr)}\nRPI command line: {command_line}'
-                raise RpiRemoteCommandError(error)
-            print(f'WARNING: {"\n".join(self.stderr)}')
+        command_line = self._command_line(command)
+        self.status, stdout, stderr = self.ssh_client.run_command(command_line, print_stdout=print_stdout)
+        self.stdout = stdout.rstrip()
+        self.stderr = stderr.rstrip()
+        self._handle_stderr(command_line, ignore_stderr=ignore_stderr)
         print()
         return self.status
 
+    def batch(self, commands: list[str], *, print_stdout: bool = True, ignore_stderr: bool = False) -> list[int]:
+        """Run a sequence of commands through one SSH channel.
 
-def rpi_get_file_path(ssh_client: SshClient, search_pattern: str, *, raise_no_file_exception: bool = True) -> str | None:
-    _stdin, stdout, stderr = ssh_client.client.exec_command(f'ls {search_pattern}')
-    status = stdout.channel.recv_exit_status()
+        All commands are executed, also when a previous one failed, unless a command ends the remote shell. The header
+        and stdout of each command are printed while the commands run, stderr is handled when all have ended.
+
+        Returns:
+            Exit status of each command.
+
+        Raises:
+            RpiRemoteCommandError: If a command was not run, because a previous command ended the remote shell.
+
+        """
+        def _print_header(index: int) -> None:
+            if index:
+                print()
+            print(f'== Remote command to RPI: {commands[index]}')
+
+        results = self.ssh_client.run_batch(
+            commands,
+            command_prefix=self._command_prefix,
+            print_stdout=print_stdout,
+            command_started=_print_header,
+        )
+        for command, (status, stdout, stderr) in zip(commands, results, strict=True):
+            if status is None:
+                error = f'Not run, because a previous command ended the remote shell.\nRPI command line: {command}'
+                raise RpiRemoteCommandError(error)
+            self.status = status
+            self.stdout = stdout.rstrip()
+            self.stderr = stderr.rstrip()
+            self._handle_stderr(self._command_line(command), ignore_stderr=ignore_stderr)
+        print()
+        return [status for status, _stdout, _stderr in results]
+
+    def _command_line(self, command: str) -> str:
+        return f'{self._command_prefix}{command}'
+
+    def _handle_stderr(self, command_line: str, *, ignore_stderr: bool) -> None:
+        if self.stderr:
+            if not ignore_stderr:
+                error = f'{self.stderr}\nRPI command line: {command_line}'
+                raise RpiRemoteCommandError(error)
+            print(f'WARNING: {self.stderr}')
+
+
+def _check_file_search_status(search_pattern: str, status: int, stderr: str, *, raise_no_file_exception: bool) -> None:
     if status:
         no_file_found = 2
         if status != no_file_found:
-            error = f'Searching files on RPI: {search_pattern}, stderr={stderr.read().decode('utf-8').strip()}'
+            error = f'Searching files on RPI: {search_pattern}, stderr={stderr.strip()}'
             raise RpiTmuxError(error)
         error = f'File not found: {search_pattern}'
         if raise_no_file_exception:
             raise RpiTmuxError(error)
-    log_files = stdout.read().decode('utf-8').strip().split('\n')
-    log_files.sort()
-    return log_files[-1]  # File name with most recent time stamp in the name
+
+
+def rpi_get_file_path(ssh_client: SshClient, search_pattern: str, *, raise_no_file_exception: bool = True) -> str | None:
+    # Shell glob expansion is sorted, so the loop ends with the file with most recent time stamp in the name.
+    # Only that file path is returned, and exit status 2 (as for ls) if there is no matching file.
+    command = f'for file in {search_pattern}; do :; done; [ -e "$file" ] || exit 2; echo "$file"'
+    status, stdout, stderr = ssh_client.run_command(command)
+    _check_file_search_status(search_pattern, status, stderr, raise_no_file_exception=raise_no_file_exception)
+    return stdout.strip()
 
 
 def _check_tmux_session(ssh_client: SshClient, session_name: str, log_file: str) -> None:
     """Check tmux session on RPI.
 
+    All checks are running as one batch on a single SSH channel.
+
     Raises:
         RpiTmuxError: If tmux session issue.
 
     """
-    rpi_get_file_path(ssh_client, log_file)
-    _stdin, stdout, stderr = ssh_client.client.exec_command(f'tmux has-session -t {session_name}')
-    exit_code = stdout.channel.recv_exit_status()
-    if exit_code != 0:
-        error = (
-            f'There is no active tmux session "{session_name}" on {ssh_client.connection}:'
-            f'\n{stderr.read().decode('utf-8').strip()}'
-        )
+    log_file_check, session_check, pipe_check = ssh_client.run_batch([
+        f'ls {log_file}',
+        f'tmux has-session -t {session_name}',
+        f'tmux display-message -p -t {session_name}:0.0 "#{{pane_pipe}}"',
+    ])
+    status, _stdout, stderr = log_file_check
+    _check_file_search_status(log_file, status, stderr, raise_no_file_exception=True)
+    status, _stdout, stderr = session_check
+    if status != 0:
+        error = f'There is no active tmux session "{session_name}" on {ssh_client.connection}:\n{stderr.strip()}'
         raise RpiTmuxError(error)
-    tmux_check_pipe = f'tmux display-message -p -t {session_name}:0.0 "#{{pane_pipe}}"'
-    _stdin, stdout, _stderr = ssh_client.client.exec_command(tmux_check_pipe)
-    if stdout.read().decode()[0] != '1':
+    _status, stdout, _stderr = pipe_check
+    if stdout[:1] != '1':
         error = f'There is no tmux piping to log file for session "{session_name}" on {ssh_client.connection}'
         raise RpiTmuxError(error)
 
 
 def rpi_tmux_terminal_output(ssh_client: SshClient, config: RpiRemoteToolsConfig) -> None:
     session_name = config.rpi_settings.tmux_session_name
-    log_file_search_pattern = config.rpi_settings.tmux_log_path_pattern.format(timestamp='*')
-    tmux_log_file_path = rpi_get_file_path(ssh_client, log_file_search_pattern)
+    tmux_log_file_path = rpi_get_file_path(ssh_client, config.rpi_settings.tmux_log_path_search_pattern)
     _check_tmux_session(ssh_client, session_name, tmux_log_file_path)
 
-    # Set up user termination thread
-    stop_event = threading.Event()
+    # tmux streaming: "tail -F" on RPI is pushing new log output through one SSH channel
+    tail_channel = ssh_client.open_session(
+        window_size=TMUX_STREAM_WINDOW_SIZE,
+        max_packet_size=TMUX_STREAM_RECEIVE_SIZE,
+    )
+    tail_channel.exec_command(f'tail -n +1 -F {tmux_log_file_path}')
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
 
-    def wait_for_enter() -> None:
-        input()  # Waits until the user presses Enter
-        stop_event.set()
+    # One selector is waiting for both log output and user termination (Enter)
+    selector = selectors.DefaultSelector()
+    selector.register(tail_channel, selectors.EVENT_READ)
+    stop_event = threading.Event()
+    if sys.platform == 'win32':  # select() on Windows only supports sockets, so a thread is waiting for Enter
 
-    input_thread = threading.Thread(target=wait_for_enter, daemon=True)
-    input_thread.start()
+        def wait_for_enter() -> None:
+            input()  # Waits until the user presses Enter
+            stop_event.set()
 
-    sftp_client = ssh_client.client.open_sftp()
-    sftp_client.stat(tmux_log_file_path)
+        threading.Thread(target=wait_for_enter, daemon=True).start()
+    else:
+        selector.register(sys.stdin, selectors.EVENT_READ)
 
-    # tmux streaming
-    remote_tmux_log = sftp_client.open(tmux_log_file_path, 'r', bufsize=4096)
     print('Press Enter to exit remote tmux session.\n')
     try:
-        error_check_time_interval = 3
+        error_check_time_interval = TMUX_CHECK_INTERVAL_MIN
         error_check_timer_start = time.monotonic()
         while not stop_event.is_set():
-            line = remote_tmux_log.readline()
-            if line:
-                sys.stdout.write(line)
-                sys.stdout.flush()
+            for key, _events in selector.select(timeout=TMUX_STREAM_SELECT_TIMEOUT):
+                if key.fileobj is sys.stdin:
+                    sys.stdin.readline()
+                    stop_event.set()
+                elif data := tail_channel.recv(TMUX_STREAM_RECEIVE_SIZE):
+                    sys.stdout.write(decoder.decode(data))
+                    sys.stdout.flush()
+                else:
+                    error = f'Streaming of tmux log file stopped: {tmux_log_file_path}'
+                    raise RpiTmuxError(error)
             if time.monotonic() - error_check_timer_start > error_check_time_interval:
                 _check_tmux_session(ssh_client, session_name, tmux_log_file_path)
+                error_check_time_interval = min(error_check_time_interval * 2, TMUX_CHECK_INTERVAL_MAX)
                 error_check_timer_start = time.monotonic()
-            time.sleep(0.02)
     finally:
-        remote_tmux_log.close()
-        sftp_client.close()
+        selector.close()
+        tail_channel.close()
 
 
 def rpi_upload_app_files(ssh_client: SshClient, config: RpiRemoteToolsConfig) -> None:
@@ -165,30 +287,62 @@ def rpi_upload_app_files(ssh_client: SshClient, config: RpiRemoteToolsConfig) ->
     ssh_client.upload_recursive(config.local_project_path, config.remote_project_folder, all_exclude_patterns)
 
 
-def _get_configurations(configurations_content: str, remote_username: str) -> RpiRemoteToolsConfig:
+@functools.lru_cache(maxsize=32)
+def _decode_configurations(configurations_content: str) -> Mapping:
     try:
-        config_data = json.loads(configurations_content)
+        return types.MappingProxyType(json.loads(configurations_content))  # Read-only, as it is shared between calls
     except json.JSONDecodeError as exception:
         error_msg = f'Error decoding configurations as JSON:\n{configurations_content}\n'
         raise ValueError(error_msg) from exception
+
+
+def _get_local_project_path(project_directory: str) -> Path:
+    return LOCAL_PROJECTS_ROOT / project_directory
+
+
+def _get_configurations(configurations_content: str, remote_username: str) -> RpiRemoteToolsConfig:
+    """Get configurations, reusing earlier created configurations as long as the settings file is unchanged.
+
+    Returns:
+        Configurations of rpi-remote-tools.
+
+    Raises:
+        FileNotFoundError: if settings file was not found.
+
+    """
+    project_directory = _decode_configurations(configurations_content)['project_directory']
+    settings_file = _get_local_project_path(project_directory) / RPI_SETTINGS_FILE
+    try:
+        settings_mtime_ns = settings_file.stat().st_mtime_ns
+    except FileNotFoundError as exception:
+        error = f'Settings file not found: {settings_file}'
+        raise FileNotFoundError(error) from exception
+    return _create_configurations(configurations_content, remote_username, settings_mtime_ns)
+
+
+@functools.lru_cache(maxsize=32)
+def _create_configurations(
+    configurations_content: str,
+    remote_username: str,
+    _settings_mtime_ns: int,  # Part of cache key only, so a modified settings file is read again
+) -> RpiRemoteToolsConfig:
+    config_data = dict(_decode_configurations(configurations_content))
     config_data['remote_project_folder'] = f'/home/{remote_username}/{config_data['project_directory']}'
-    local_project_path = (Path(__file__).parent / '..' / '..' / config_data['project_directory']).resolve()
+    local_project_path = _get_local_project_path(config_data['project_directory'])
     config_data['local_project_path'] = local_project_path
 
     settings_file = local_project_path / RPI_SETTINGS_FILE
-    if not Path(settings_file).exists():
-        error = f'Settings file not found: {settings_file}'
-        raise FileNotFoundError(error)
-    settings_data = configparser.ConfigParser()
+    settings_data = configparser.RawConfigParser()  # No %-interpolation, patterns are formatted explicitly
     settings_data.read(settings_file)
     settings = settings_data[RPI_SETTINGS_FILE_SETTINGS_KEYWORD]
     settings['tmux_log_path_pattern'] = settings['tmux_log_path_pattern'].format(
         session_name=settings['tmux_session_name'],
         timestamp=r'{timestamp}',
     )
-    config_data['rpi_settings'] = _RpiSettings(**settings)
+    settings['tmux_log_path_search_pattern'] = settings['tmux_log_path_pattern'].format(timestamp='*')
+    config_data['rpi_settings'] = _RpiSettings.from_dict(settings)
 
-    return RpiRemoteToolsConfig(**config_data)
+    return RpiRemoteToolsConfig.from_dict(config_data)
 
 
 def rpi_upload(ssh_client: SshClient, config: RpiRemoteToolsConfig, rpi_make_file: str, *, force_upload: bool) -> bool:
@@ -238,9 +392,7 @@ def rpi_install(rpi_command: RpiCommand) -> None:
 
 def rpi_stop_all(rpi_command: RpiCommand, *, make_file_exist: bool = True) -> None:
     if make_file_exist:
-        rpi_command.command('make stop-app')
-        rpi_command.command('make kill-tmux')
-        rpi_command.command('make stop-service')
+        rpi_command.batch(['make stop-app', 'make kill-tmux', 'make stop-service'])
 
 
 def execute_command(args: argparse.Namespace) -> None:
@@ -267,8 +419,7 @@ def execute_command(args: argparse.Namespace) -> None:
         if args.rpi_stop:
             rpi_stop_all(rpi_command)
         if args.rpi_restart:
-            rpi_stop_all(rpi_command)
-            rpi_command.command('make start-service')
+            rpi_command.command('make restart')  # Stops application, tmux and service, then starts service
         if args.rpi_run_app_in_tmux:
             rpi_stop_all(rpi_command)
             rpi_command.command('make run')
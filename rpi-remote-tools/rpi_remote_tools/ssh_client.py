@@ -1,13 +1,25 @@
 """SSH Client."""
+import fnmatch
 import getpass
+import hashlib
+import io
+import os
+import re
+import shlex
 import stat
+import threading
 import types
-from contextlib import suppress
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePosixPath
 
 import paramiko
 import yaml
 
+from .batch_output import batch_sentinel, split_batch_output
+
+UPLOAD_WORKERS = 8  # Number of files uploaded concurrently (each on its own SFTP channel)
+
 
 class SshClient:
     """SSH Client containing SSH connection client and some configuration values."""
@@ -15,6 +27,7 @@ class SshClient:
     def __init__(self, client: paramiko.SSHClient, config: dict[str, str]) -> None:
         """Set client to a paramiko ssh client."""
         self._client = client
+        self._transport = client.get_transport()
         self._username = config['username']
         self._connection = f'{config['username']}@{config['hostname']}'
         self._sftp = None
@@ -34,9 +47,122 @@ class SshClient:
         """Provide ssh connection name (username@hostname)."""
         return self._connection
 
+    def open_session(self, window_size: int | None = None, max_packet_size: int | None = None) -> paramiko.Channel:
+        """Open a new channel on the already established SSH transport.
+
+        Args:
+            window_size: SSH channel window size in bytes (paramiko default if None).
+            max_packet_size: Max SSH packet size in bytes (paramiko default if None).
+
+        Returns:
+            A session channel, opened without a new connection or authentication.
+
+        """
+        return self._transport.open_session(window_size=window_size, max_packet_size=max_packet_size)
+
+    def run_command(self, command: str, *, print_stdout: bool = False) -> tuple[int, str, str]:
+        """Run a command and collect its output.
+
+        stdout and stderr are read concurrently while the command runs, so a lot of output on one of them can not
+        fill up the SSH channel window and stall the command.
+
+        Args:
+            command: Shell command to run.
+            print_stdout: Print stdout lines as they arrive, while the command is running.
+
+        Returns:
+            Exit status, stdout and stderr of the command.
+
+        """
+        def _print_stdout_line(line: str) -> None:
+            print(line, end='', flush=True)
+
+        status, stdout_output, stderr_output = self._run_command(command, _print_stdout_line if print_stdout else None)
+        if print_stdout and stdout_output and not stdout_output.endswith('\n'):
+            print()
+        return status, stdout_output, stderr_output
+
+    def run_batch(
+        self,
+        commands: list[str],
+        *,
+        command_prefix: str = '',
+        print_stdout: bool = False,
+        command_started: Callable[[int], None] | None = None,
+    ) -> list[tuple[int | None, str, str]]:
+        """Run a sequence of commands with one exec request (one SSH channel).
+
+        Every command is followed by a sentinel on both stdout and stderr, so output and exit status can be split
+        per command afterwards. All commands are executed, also when a previous one failed, unless a command ends
+        the shell (e.g. with "exit").
+
+        Args:
+            commands: Shell commands to run in sequence.
+            command_prefix: Prefix of the command line (e.g. "cd <folder> && ") applying to all commands.
+            print_stdout: Print stdout lines (without the sentinels) as they arrive, while the commands are running.
+            command_started: Called with the command index when a command starts (e.g. for printing a header).
+
+        Returns:
+            Exit status (None if not run), stdout and stderr of each command.
+
+        """
+        index = 0  # Command running on RPI, next when its sentinel has arrived
+
+        def _handle_stdout_line(line: str) -> None:
+            nonlocal index
+            if index >= len(commands):  # All commands have ended
+                return
+            output, found, _status = line.partition(f'{batch_sentinel(index)}=')
+            if print_stdout and output:
+                print(output if not found else f'{output}\n', end='', flush=True)
+            if found:
+                index += 1
+                if command_started and index < len(commands):
+                    command_started(index)
+
+        script = ' '.join(
+            f'{command}; echo "{batch_sentinel(command_index)}=$?"; echo "{batch_sentinel(command_index)}" >&2;'
+            for command_index, command in enumerate(commands)
+        )
+        if command_started and commands:
+            command_started(0)
+        line_handler = _handle_stdout_line if print_stdout or command_started else None
+        channel_status, stdout_output, stderr_output = self._run_command(f'{command_prefix}{{ {script} }}', line_handler)
+        return split_batch_output(stdout_output, stderr_output, len(commands), channel_status)
+
+    def _run_command(self, command: str, stdout_line_handler: Callable[[str], None] | None) -> tuple[int, str, str]:
+        """Run a command, reading stdout (passing each line to stdout_line_handler if given) and stderr concurrently.
+
+        Returns:
+            Exit status, stdout and stderr of the command.
+
+        """
+        _stdin, stdout, stderr = self.client.exec_command(command)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stderr_output = executor.submit(stderr.read)
+            if stdout_line_handler:
+                stdout_lines = []
+                for line in stdout:
+                    stdout_line_handler(line)
+                    stdout_lines.append(line)
+                stdout_output = ''.join(stdout_lines)
+            else:
+                stdout_output = stdout.read().decode('utf-8')
+            return stdout.channel.recv_exit_status(), stdout_output, stderr_output.result().decode('utf-8')
+
     def upload_recursive(self, local_dir: Path, remote_folder: str, exclude_patterns: list[str] | None) -> None:
-        """Upload files to remote device like rsync."""
+        """Upload files to remote device like rsync.
+
+        Only files with content differing from the remote file are uploaded, by comparing SHA-256 hashes (the remote
+        hashes are fetched with one command). Files are uploaded concurrently, each worker thread using its own SFTP
+        channel.
+
+        Exclude patterns are shell-style wildcards (fnmatch) matched against file and folder names. Excluded folders
+        are not descended into.
+        """
         exclude = exclude_patterns or []
+        # One regex for all patterns ("(?!)" never matches if there are no patterns)
+        exclude_matcher = re.compile('|'.join(fnmatch.translate(pattern) for pattern in exclude) or '(?!)')
 
         # Use PurePosixPath for remote paths
         remote_dir = PurePosixPath(f'{remote_folder}')
@@ -44,80 +170,124 @@ class SshClient:
         print(f'Syncing {local_dir} to {self.connection}: {remote_dir}')
         self._sftp = self.client.open_sftp()
 
-        def _upload_dir(local_path: Path, remote_path: PurePosixPath) -> None:
-            with suppress(OSError):
-                self._sftp.mkdir(str(remote_path))
-            for item in local_path.iterdir():
-                local_item = item
-                remote_item = remote_path / item.name
-                if self._is_excluded(local_item, exclude):
-                    continue
-                if local_item.is_dir():
-                    _upload_dir(local_item, remote_item)
-                else:
-                    _upload_file_if_newer(local_item, remote_item)
-
-        def _upload_file_if_newer(local_file: Path, remote_file: PurePosixPath) -> None:
-            local_mtime = local_file.stat().st_mtime
-            try:
-                remote_attr = self._sftp.stat(str(remote_file))
-                remote_mtime = remote_attr.st_mtime
-                if int(local_mtime) > int(remote_mtime):  # Local file is newer
-                    print(f'  Updating remote file: {remote_file}')
-                    _upload_file(local_file, remote_file, local_mtime)
-            except OSError:
-                # File does not exist remotely, so upload it
+        thread_data = threading.local()
+        thread_sftp_clients = []
+        thread_sftp_clients_lock = threading.Lock()
+
+        def _thread_sftp() -> paramiko.SFTPClient:
+            if not hasattr(thread_data, 'sftp'):
+                thread_data.sftp = self.client.open_sftp()
+                with thread_sftp_clients_lock:
+                    thread_sftp_clients.append(thread_data.sftp)
+            return thread_data.sftp
+
+        def _upload_file_if_changed(upload_item: tuple[Path, PurePosixPath]) -> None:
+            local_file, remote_path = upload_item
+            remote_file = str(remote_path)  # Converted once, used for hash lookup, messages and SFTP requests
+            content = local_file.read_bytes()  # Read once, for both hashing and uploading
+            remote_hash = remote_hashes.get(remote_file)
+            if remote_hash == hashlib.sha256(content).hexdigest():
+                return
+            if remote_hash is None:
                 print(f'  Uploading new file: {remote_file}')
-                _upload_file(local_file, remote_file, local_mtime)
+            else:
+                print(f'  Updating remote file: {remote_file}')
+            _upload_file(_thread_sftp(), content, remote_file, local_file.stat().st_mtime)
 
-        def _upload_file(local_file: Path, remote_file: PurePosixPath, local_mtime: float) -> None:
-            self._sftp.put(str(local_file), str(remote_file))
-            self._sftp.utime(str(remote_file), (local_mtime, local_mtime))
+        def _upload_file(sftp: paramiko.SFTPClient, content: bytes, remote_file: str, local_mtime: float) -> None:
+            # putfo() is pipelining writes, confirm=False skips its extra stat request (write errors are raised anyway)
+            sftp.putfo(io.BytesIO(content), remote_file, file_size=len(content), confirm=False)
+            sftp.utime(remote_file, (local_mtime, local_mtime))
 
-        self._delete_extra_remote_files(local_dir, remote_dir, exclude)
-        _upload_dir(local_dir, remote_dir)
-        self._sftp.close()
+        try:
+            self._delete_extra_remote_files(local_dir, remote_dir, exclude_matcher)
+            remote_dirs, upload_items = self._get_upload_items(local_dir, remote_dir, exclude_matcher)
+            remote_hashes = self._get_remote_file_hashes(remote_dir, exclude)
+            # All directories with one command, before uploading concurrently
+            self.run_command(f'mkdir -p {shlex.join(str(remote_path) for remote_path in remote_dirs)}')
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                list(executor.map(_upload_file_if_changed, upload_items))  # list() is re-raising upload exceptions
+        finally:
+            for sftp in thread_sftp_clients:
+                sftp.close()
+            self._sftp.close()
+
+    def _get_remote_file_hashes(self, remote_dir: PurePosixPath, exclude: list[str]) -> dict[str, str]:
+        """Calculate SHA-256 hashes of all remote files (excluded folders are not searched).
+
+        Returns:
+            Hash of each remote file path.
+
+        """
+        prune = ' -o '.join(f'-name {shlex.quote(pattern)}' for pattern in exclude) or '-false'
+        command = f'find {shlex.quote(str(remote_dir))} \\( {prune} \\) -prune -o -type f -exec sha256sum {{}} +'
+        _status, stdout, _stderr = self.run_command(command)
+        remote_hashes = {}
+        for line in stdout.splitlines():
+            file_hash, _, file_path = line.partition('  ')
+            remote_hashes[file_path] = file_hash
+        return remote_hashes
 
     @staticmethod
-    def _is_excluded(path: Path, exclude: list[str]) -> bool:
-        return any(
-            pattern in str(path) or path.name == pattern or str(path).endswith(pattern)
-            for pattern in exclude
-        )
+    def _get_upload_items(
+        local_dir: Path,
+        remote_dir: PurePosixPath,
+        exclude: re.Pattern,
+    ) -> tuple[list[PurePosixPath], list[tuple[Path, PurePosixPath]]]:
+        """Walk local directory tree.
+
+        Returns:
+            Remote directories and (local file, remote file) pairs to upload.
+
+        """
+        remote_dirs = []
+        upload_items = []
+        for root, dirs, files in os.walk(local_dir):
+            dirs[:] = [name for name in dirs if not exclude.match(name)]  # Prune excluded folders
+            local_path = Path(root)
+            remote_path = remote_dir.joinpath(*local_path.relative_to(local_dir).parts)
+            remote_dirs.append(remote_path)
+            upload_items.extend(
+                (local_path / name, remote_path / name) for name in files if not exclude.match(name)
+            )
+        return remote_dirs, upload_items
 
-    def _delete_extra_remote_files(self, local_path: Path, remote_path: PurePosixPath, exclude: list[str]) -> None:
+    def _delete_extra_remote_files(self, local_dir: Path, remote_dir: PurePosixPath, exclude: re.Pattern) -> None:
+        """Delete remote files and folders which do not exist locally, all with one command."""
+        if extra_remote_paths := self._get_extra_remote_paths(local_dir, remote_dir, exclude):
+            self.run_command(f'rm -rf {shlex.join(str(remote_path) for remote_path in extra_remote_paths)}')
 
+    def _get_extra_remote_paths(
+        self,
+        local_path: Path,
+        remote_path: PurePosixPath,
+        exclude: re.Pattern,
+    ) -> list[PurePosixPath]:
+        """Find remote files and folders which do not exist locally.
+
+        Returns:
+            Remote paths to delete (for folders only the folder itself, not its content).
+
+        """
+        extra_remote_paths = []
         try:
-            for item in self._sftp.listdir(str(remote_path)):
-                remote_item = remote_path / item
-                local_item = local_path / item
+            for attr in self._sftp.listdir_attr(str(remote_path)):  # Names with their attributes in one request
+                remote_item = remote_path / attr.filename
+                local_item = local_path / attr.filename
 
-                if self._is_excluded(remote_item, exclude):
+                if exclude.match(attr.filename):
                     continue
 
-                try:
-                    attr = self._sftp.stat(str(remote_item))
-                    if stat.S_ISDIR(attr.st_mode):  # Directory
-                        if not local_item.is_dir():
-                            self._remove_remote_dir(remote_item)
-                        else:
-                            self._delete_extra_remote_files(local_item, remote_item, exclude)
-                    elif not local_item.exists():
-                        self._sftp.remove(str(remote_item))
-                except OSError:
-                    pass
+                if stat.S_ISDIR(attr.st_mode):  # Directory
+                    if not local_item.is_dir():
+                        extra_remote_paths.append(remote_item)
+                    else:
+                        extra_remote_paths.extend(self._get_extra_remote_paths(local_item, remote_item, exclude))
+                elif not local_item.is_file():
+                    extra_remote_paths.append(remote_item)
         except OSError:
             pass
-
-    def _remove_remote_dir(self, path: PurePosixPath) -> None:
-        for item in self._sftp.listdir(str(path)):
-            remote_item = path / item
-            attr = self._sftp.stat(str(remote_item))
-            if stat.S_ISDIR(attr.st_mode):  # Directory
-                self._remove_remote_dir(remote_item)
-            else:
-                self._sftp.remove(str(remote_item))
-        self._sftp.rmdir(str(path))
+        return extra_remote_paths
 
 
 class SshClientHandler:
@@ -145,6 +315,7 @@ class SshClientHandler:
             hostname=self._config['hostname'],
             username=self._config['username'],
             password=self._config['password'],
+            compress=True,  # Less data over (Wi-Fi) network when uploading code
         )
         self._client = SshClient(client, self._config)
         return self._client
@@ -23,8 +23,8 @@ class Uninstaller(InstallerTools):
             print('tmux not found. No uninstalling...')
             return
         print('Uninstalling tmux')
-        run_command('tmux kill-server', check=False)
-        run_command('sudo apt-get remove -y tmux')
+        run_command(['tmux', 'kill-server'], check=False)
+        run_command(['sudo', 'apt-get', 'remove', '-y', 'tmux'], capture_stdout=False)
         if self.is_tmux_installed():
             error = 'Could not uninstall tmux.'
             raise UninstallError(error)
@@ -34,7 +34,7 @@ class Uninstaller(InstallerTools):
             print('uv not found. No uninstalling...')
             return
         print('Uninstalling uv')
-        run_command('sudo snap remove astral-uv')
+        run_command(['sudo', 'snap', 'remove', 'astral-uv'], capture_stdout=False)
         if self.is_uv_installed():
             error = 'Could not uninstall uv.'
             raise UninstallError(error)
@@ -44,7 +44,7 @@ class Uninstaller(InstallerTools):
             print('snap not found. No uninstalling...')
             return
         print('Uninstalling snap')
-        run_command('sudo apt-get purge snapd -y')
+        run_command(['sudo', 'apt-get', 'purge', 'snapd', '-y'], capture_stdout=False)
         if self.is_snap_installed():
             error = 'Could not uninstall snap.'
             raise UninstallError(error)
@@ -2,12 +2,16 @@
 import configparser
 import enum
 import filecmp
+import os
+import select
+import shutil
+import signal
+import socket
 import subprocess  # noqa: S404 `subprocess` module is possibly insecure
 import time
+from collections.abc import Callable
 from contextlib import suppress
-from datetime import datetime
 from pathlib import Path
-from zoneinfo import ZoneInfo
 
 SETTINGS_FILE = 'settings.ini'
 LOCAL_SERVICE_DIRECTORY = Path(__file__).parent / '..' / 'system-service'
@@ -48,12 +52,12 @@ class TmuxSessionKillError(Exception):
     """Could not kill tmux session."""
 
 
-class KillSignals(enum.StrEnum):
+class KillSignals(enum.IntEnum):
     """Kill signals for stopping application on RPI."""
 
-    SIGTERM = '-15'  # Terminate gracefully
-    SIGINT = '-2'  # Ctrl+C
-    SIGKILL = '-9'  # Force kill
+    SIGTERM = signal.SIGTERM  # Terminate gracefully
+    SIGINT = signal.SIGINT  # Ctrl+C
+    SIGKILL = signal.SIGKILL  # Force kill
 
 
 class ServiceStatus(enum.StrEnum):
@@ -65,13 +69,20 @@ class ServiceStatus(enum.StrEnum):
     NOT_FOUND = 'not found'
 
 
-def run_command(command: str, *, check: bool = True, raise_std_error: bool = True) -> subprocess.CompletedProcess:
-    r"""Run a shell command.
+def run_command(
+    command: str | list[str],
+    *,
+    check: bool = True,
+    raise_std_error: bool = True,
+    capture_stdout: bool = True,
+) -> subprocess.CompletedProcess:
+    r"""Run a command.
 
     Args:
-        command: The command to run.
+        command: The command to run, a string is run by the shell and a list (program and arguments) is run directly.
         check: Whether to raise an error on a non-zero exit code.
         raise_std_error: Whether to raise an error if there is output on stderr.
+        capture_stdout: Whether to capture stdout, else it is discarded (stdout of the result is None).
 
     Returns:
         The CompletedProcess instance.
@@ -81,8 +92,10 @@ def run_command(command: str, *, check: bool = True, raise_std_error: bool = Tru
         subprocess.CalledProcessError: If the command fails and check is True, or .
 
     """
-    # Ruff S602 = `subprocess` call with `shell=True` identified, security issue
-    result = subprocess.run(command, shell=True, check=check, capture_output=True, text=True)  # noqa: S602
+    # Ruff S603 = `subprocess` call: check for execution of untrusted input, security issue
+    shell = isinstance(command, str)  # Only shell syntax (variables, wildcards, ...) needs a /bin/sh process in between
+    stdout = subprocess.PIPE if capture_stdout else subprocess.DEVNULL
+    result = subprocess.run(command, shell=shell, check=check, stdout=stdout, stderr=subprocess.PIPE, text=True)  # noqa: S603
     if raise_std_error and result.stderr:
         raise subprocess.CalledProcessError(
             result.returncode,
@@ -93,6 +106,46 @@ def run_command(command: str, *, check: bool = True, raise_std_error: bool = Tru
     return result
 
 
+def wait_for(condition: Callable[[], bool], timeout: float, max_poll_interval: float = 0.2) -> bool:
+    """Wait until a condition is met.
+
+    The poll interval starts at 20 ms and is doubled for each poll up to max_poll_interval, so a condition which is
+    met quickly is detected quickly, without polling a slow one too often.
+
+    Args:
+        condition: Function returning True when the condition is met.
+        timeout: Max seconds to wait.
+        max_poll_interval: Max seconds between polls.
+
+    Returns:
+        True if the condition was met within timeout, False otherwise.
+
+    """
+    deadline = time.monotonic() + timeout
+    poll_interval = 0.02
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+    return True
+
+
+def _wait_processes_ended(pidfds: dict[str, int], timeout: float) -> list[str]:
+    """Wait for processes to end, a pidfd gets readable when its process has ended.
+
+    Returns:
+        IDs of processes still running after timeout.
+
+    """
+    deadline = time.monotonic() + timeout
+    running = dict(pidfds)
+    while running and (time_left := deadline - time.monotonic()) > 0:
+        ended_pidfds, _, _ = select.select(list(running.values()), [], [], time_left)
+        running = {pid: pidfd for pid, pidfd in running.items() if pidfd not in ended_pidfds}
+    return list(running)
+
+
 def _files_are_different(file1: Path, file2: Path) -> bool:
     """Compare two files.
 
@@ -116,11 +169,13 @@ class Settings:
 
         """
         setting_path = Path(__file__).parent / '..' / SETTINGS_FILE
-        if not Path(setting_path).exists():
+        try:
+            settings_text = setting_path.read_text(encoding='utf-8')  # One open, no separate existence check
+        except FileNotFoundError as exception:
             error = f'Settings file not found: {setting_path}'
-            raise FileNotFoundError(error)
-        settings = configparser.ConfigParser()
-        settings.read(setting_path)
+            raise FileNotFoundError(error) from exception
+        settings = configparser.RawConfigParser()  # No %-interpolation, patterns are formatted explicitly
+        settings.read_string(settings_text, source=str(setting_path))
 
         for key, value in settings['settings'].items():
             setattr(self, key, value)
@@ -138,7 +193,7 @@ class Settings:
         )
         self.tmux_log_path_search_pattern = Path(tmux_log_path_pattern.format(timestamp='*'))
         self.tmux_log_bak_path_search_pattern = Path(tmux_log_path_pattern.format(timestamp='*') + '.bak')
-        timestamp = datetime.now(tz=ZoneInfo('UTC')).strftime('%Y%m%d-%H%M%S')
+        timestamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())  # UTC, without loading time zone data
         self.tmux_log_path = Path(tmux_log_path_pattern.format(timestamp=timestamp))
 
 
@@ -168,15 +223,16 @@ class ApplicationProcess:
         return status, result.stdout
 
     def wait_service_status(self, expected_status: ServiceStatus, timeout: float = 5) -> None:
-        start_time = time.monotonic()
-        while True:
+        status, status_log = None, ''
+
+        def _has_expected_status() -> bool:
+            nonlocal status, status_log
             status, status_log = self.get_service_status()
-            if status == expected_status:
-                return
-            if time.monotonic() > start_time + timeout:
-                error = f'Unexpected service status. Expected: {expected_status}, Actual: {status}\n{status_log}'
-                raise ServiceError(error)
-            time.sleep(0.5)
+            return status == expected_status
+
+        if not wait_for(_has_expected_status, timeout, max_poll_interval=0.5):
+            error = f'Unexpected service status. Expected: {expected_status}, Actual: {status}\n{status_log}'
+            raise ServiceError(error)
 
     def restart_service(self) -> None:
         print(f'Restarting {settings.service_name}.service')
@@ -187,24 +243,25 @@ class ApplicationProcess:
 
     def start_service(self) -> None:
         if _files_are_different(settings.local_start_script, settings.system_start_script_path):
-            run_command(f'sudo chmod +x {settings.local_start_script}')
-            run_command(f'sudo cp {settings.local_start_script} {settings.system_start_script_path}')
+            run_command(
+                ['sudo', 'install', '-m', '755', str(settings.local_start_script), str(settings.system_start_script_path)],
+            )
         if _files_are_different(settings.local_service_file, settings.system_service_file_path):
-            run_command(f'sudo cp {settings.local_service_file} {settings.system_service_file_path}')
+            run_command(
+                ['sudo', 'install', '-m', '644', str(settings.local_service_file), str(settings.system_service_file_path)],
+            )
+            run_command(['sudo', 'systemctl', 'daemon-reload'])  # Only needed when the unit file has changed
 
-        run_command(f'sudo systemctl enable {settings.service_file_name}', check=False, raise_std_error=False)
-        self.wait_service_status(ServiceStatus.ENABLED_INACTIVE)
-        run_command(f'sudo systemctl start {settings.service_file_name}')
-        run_command('sudo systemctl daemon-reload')
+        # Enable and start with one systemctl call (service status is checked afterwards)
+        run_command(['sudo', 'systemctl', 'enable', '--now', settings.service_file_name], check=False, raise_std_error=False)
         self.wait_service_status(ServiceStatus.ACTIVE)
         print(f'Service "{settings.service_file_name}" has been started successfully!')
 
     def remove_service(self, *, show_no_service_to_remove_msg: bool = True) -> None:
         def _remove_service_files() -> None:
-            if Path(settings.system_service_file_path).exists():
-                run_command(f'sudo rm {settings.system_service_file_path}')
-            if Path(settings.system_start_script_path).exists():
-                run_command(f'sudo rm {settings.system_start_script_path}')
+            service_files = [settings.system_service_file_path, settings.system_start_script_path]
+            if existing_files := [str(service_file) for service_file in service_files if service_file.exists()]:
+                run_command(['sudo', 'rm', *existing_files])  # All files with one sudo
 
         service_status, _service_log = self.get_service_status()
         if service_status not in {ServiceStatus.ACTIVE, ServiceStatus.ENABLED_INACTIVE}:
@@ -213,20 +270,24 @@ class ApplicationProcess:
             _remove_service_files()
             return
         print(f'Removing service {settings.service_file_name}')
-        run_command(f'sudo systemctl disable --now {settings.service_file_name}', check=False, raise_std_error=False)
+        run_command(['sudo', 'systemctl', 'disable', '--now', settings.service_file_name], check=False, raise_std_error=False)
         self.wait_service_status(ServiceStatus.INACTIVE)
         _remove_service_files()
-        run_command('sudo systemctl daemon-reload')
+        run_command(['sudo', 'systemctl', 'daemon-reload'])
 
     @staticmethod
     def _get_process_table(process: str) -> tuple[list[str], list[dict[str, str]]]:
         """Get all ID of all running application processes.
 
+        Processes are found by scanning /proc, ps is only run (for the table columns) when there are any.
+
         Returns:
             List of running application process id's as row text list and dict table.
 
         """
-        result = run_command('TZ=UTC ps aux', check=False)
+        if not (process_ids := ApplicationProcess._get_process_ids(process)):
+            return [], []
+        result = run_command(f'TZ=UTC ps u -p {",".join(process_ids)}', check=False)
         all_app_proc_output = result.stdout.split('\n')
         header_line = all_app_proc_output[0]
         headers = header_line.split()
@@ -244,6 +305,24 @@ class ApplicationProcess:
             proc_output_print_lines = []
         return proc_output_print_lines, proc_table
 
+    @staticmethod
+    def _get_process_ids(process: str) -> list[str]:
+        """Get IDs of processes having process in their command line, by reading /proc (no ps process is started).
+
+        Returns:
+            Process IDs.
+
+        """
+        pattern = process.encode()
+        process_ids = []
+        with os.scandir('/proc') as proc_entries:
+            for entry in proc_entries:
+                if entry.name.isdigit():
+                    with suppress(OSError):  # Process has ended while scanning
+                        if pattern in Path(entry.path, 'cmdline').read_bytes():
+                            process_ids.append(entry.name)
+        return process_ids
+
     def get_application_ids_table(self, *, print_message: bool = True) -> tuple[list[str], list[dict[str, str]]]:
         table_rows, proc_table = self._get_process_table(settings.application_script)
         if proc_table:
@@ -295,8 +374,8 @@ class ApplicationProcess:
         print(f'Killing process "{app_pid_filter}...{settings.application_script}". PID(s): {", ".join(proc_kill_list)}')
         self._stop_application(proc_kill_list)
 
-        printout, proc_table = self.get_application_ids_table(print_message=False)
-        if proc_table:
+        if self._get_process_ids(settings.application_script):
+            printout, _proc_table = self.get_application_ids_table(print_message=False)
             error_message = f'Still active PID(s)\n{printout}'
             raise ProcessKillError(error_message)
 
@@ -304,48 +383,55 @@ class ApplicationProcess:
     def _stop_application(proc_kill_list: list) -> None:
         """Stop application on RPI.
 
+        Each kill signal is sent to all remaining processes before waiting for them to end. The processes are signalled
+        and waited for through pidfds, so a reused PID can not be hit and the wait ends as soon as the processes end.
+
         Raises:
             ProcessKillError: If application could not get killed.
 
         """
-        for pid in proc_kill_list:
+        pidfds = {}
+        try:
+            for pid in proc_kill_list:
+                with suppress(ProcessLookupError):  # Process has ended already
+                    pidfds[pid] = os.pidfd_open(int(pid))
+            remaining_pids = list(pidfds)
             for kill_signal in KillSignals:
-                error = f'Failed to kill "{settings.application_script}" (PID {pid}) with {kill_signal.name}'
-                result = run_command(f'kill {kill_signal.value} {pid}', check=False, raise_std_error=False)
-                if result.returncode != 0:
-                    error_message = f'{error}: {result.stderr.strip()}'
-                    raise ProcessKillError(error_message)
-                check_reties = 10
-                while True:
-                    time.sleep(0.2)
-                    result = run_command(f'ps -p {pid}', check=False)
-                    if result.returncode != 0:
-                        error = ''
-                        break
-                    check_reties -= 1
-                    if check_reties < 0:
-                        break
-                if not error:
-                    break
-                print(error)
-            if error:
-                raise ProcessKillError(error)
-            print(f'Successfully killed PID {pid} with {kill_signal.name}')
+                for pid in remaining_pids:
+                    try:
+                        with suppress(ProcessLookupError):  # Process has ended already
+                            signal.pidfd_send_signal(pidfds[pid], kill_signal)
+                    except OSError as exception:
+                        error = f'Failed to kill "{settings.application_script}" (PID {pid}) with {kill_signal.name}: {exception}'
+                        raise ProcessKillError(error) from exception
+                alive_pids = _wait_processes_ended({pid: pidfds[pid] for pid in remaining_pids}, timeout=2)
+                for pid in remaining_pids:
+                    if pid not in alive_pids:
+                        print(f'Successfully killed PID {pid} with {kill_signal.name}')
+                if not (remaining_pids := alive_pids):
+                    return
+                print(f'Failed to kill "{settings.application_script}" (PID {", ".join(remaining_pids)}) with {kill_signal.name}')
+        finally:
+            for pidfd in pidfds.values():
+                os.close(pidfd)
+        error = f'Failed to kill "{settings.application_script}" (PID {", ".join(remaining_pids)})'
+        raise ProcessKillError(error)
 
     def start_application_in_tmux_session(self) -> None:
         print(f'Starting application "{settings.application_script}" in tmux session: {settings.tmux_session_name}')
         self.kill_tmux_session(show_messages=False)
-        run_command(f'tmux new-session -d -s {settings.tmux_session_name}')
-        run_command(f'tmux pipe-pane -t {settings.tmux_session_name}:0.0 -o "cat >> {settings.tmux_log_path}"')
+        run_command(['tmux', 'new-session', '-d', '-s', settings.tmux_session_name])
+        settings.tmux_log_path.touch()  # Log file exists right away, also before pipe-pane has started appending to it
+        run_command(['tmux', 'pipe-pane', '-t', f'{settings.tmux_session_name}:0.0', '-o', f'cat >> {settings.tmux_log_path}'])
         app_run_command = f'uv run --no-group dev {settings.application_script}'
-        run_command(f'tmux send-keys -t {settings.tmux_session_name}:0.0 "{app_run_command}" C-m')
+        run_command(['tmux', 'send-keys', '-t', f'{settings.tmux_session_name}:0.0', app_run_command, 'C-m'])
         print(f'Tmux log file: {settings.tmux_log_path}')
         print('TO ENTER TMUX TERMINAL ON DEVICE: make tmux')
 
     def tmux(self) -> None:
         if not self.is_tmux_active(raise_exception=False, print_status=False):
             print(f'\nThere is no tmux session for {settings.tmux_session_name}!\n')
-        run_command(f'tmux attach -t {settings.tmux_session_name}')
+        run_command(['tmux', 'attach', '-t', settings.tmux_session_name])
 
     @staticmethod
     def _get_file_paths_sorted(search_pattern: str, *, raise_no_file_exception: bool = False) -> list[Path]:
@@ -362,7 +448,7 @@ class ApplicationProcess:
         if self.is_tmux_active(raise_exception=False, print_status=False):
             if show_messages:
                 print(f'Killing tmux session: {settings.tmux_session_name}')
-            run_command(f'tmux kill-session -t {settings.tmux_session_name}')
+            run_command(['tmux', 'kill-session', '-t', settings.tmux_session_name])
             if self.is_tmux_active(print_status=False):
                 kill_error = f'Failed to kill tmux session: {settings.tmux_session_name}'
                 raise TmuxSessionKillError(kill_error)
@@ -386,17 +472,30 @@ class ApplicationProcess:
         Returns:
             True if tmux session is active, False otherwise.
 
+        Raises:
+            subprocess.CalledProcessError: If raise_exception and tmux server is running without the session.
+
         """
-        if run_command('tmux ls', check=False, raise_std_error=False).returncode != 0:
+        # Socket of tmux server used by tmux commands: the one of the tmux session we are in ($TMUX), else the default
+        # Ruff S108 = Probable insecure usage of temporary file (it is where tmux puts it)
+        default_socket = Path(os.environ.get('TMUX_TMPDIR') or '/tmp', f'tmux-{os.getuid()}', 'default')  # noqa: S108
+        tmux_socket = os.environ.get('TMUX', '').partition(',')[0] or str(default_socket)
+        with socket.socket(socket.AF_UNIX) as tmux_server:
+            try:
+                tmux_server.connect(tmux_socket)
+            except OSError:  # No socket, or socket left behind by an ended tmux server (connection refused)
+                server_running = False
+            else:
+                server_running = True
+        if not server_running:  # No tmux server, no need to run tmux
             status = False
         else:
-            command = f'tmux has-session -t {settings.tmux_session_name}'
-            if raise_exception:
-                result = run_command(command)
-            else:
-                with suppress(subprocess.CalledProcessError):
-                    result = run_command(command)
+            command = ['tmux', 'has-session', '-t', settings.tmux_session_name]
+            result = run_command(command, check=False, raise_std_error=False, capture_stdout=False)
             status = (result.returncode == 0)
+            # tmux server ended after the socket check is not an error, as when the socket check found no server
+            if raise_exception and not status and 'no server running' not in result.stderr:
+                raise subprocess.CalledProcessError(result.returncode, result.args, stderr=result.stderr)
         if print_status:
             print(
                 f'{TerminalColors.STATUS_HEADER}Tmux session "{settings.tmux_session_name}":{TerminalColors.RESET}',
@@ -432,9 +531,9 @@ class InstallerTools:
         """Run apt upgrade if not skipped."""
         if not self._skip_apt_get_upgrade:
             print('Running apt-get upgrade')
-            run_command('sudo apt-get update')
-            run_command('sudo apt-get install -y')
-            run_command('sudo apt-get upgrade -y')
+            run_command(['sudo', 'apt-get', 'update'], capture_stdout=False)
+            run_command(['sudo', 'apt-get', 'install', '-y'], capture_stdout=False)
+            run_command(['sudo', 'apt-get', 'upgrade', '-y'], capture_stdout=False)
 
     @staticmethod
     def is_tmux_installed() -> bool:
@@ -444,11 +543,7 @@ class InstallerTools:
             True if tmux is installed, False otherwise.
 
         """
-        try:
-            run_command('which tmux', check=True)
-        except subprocess.CalledProcessError:
-            return False
-        return True
+        return shutil.which('tmux') is not None
 
     @staticmethod
     def is_uv_installed() -> bool:
@@ -458,11 +553,7 @@ class InstallerTools:
             True if uv is installed, False otherwise.
 
         """
-        try:
-            run_command('which uv', check=True)
-        except subprocess.CalledProcessError:
-            return False
-        return True
+        return shutil.which('uv') is not None
 
     @staticmethod
     def is_snap_installed() -> bool:
@@ -472,16 +563,13 @@ class InstallerTools:
             True if snap is installed, False otherwise.
 
         """
-        try:
-            run_command('which snap', check=True)
-        except subprocess.CalledProcessError:
-            return False
-        return True
+        return shutil.which('snap') is not None
 
     @staticmethod
     def check_install_candidates(installable: list, candidates: list) -> list:
-        unknown_items = set(candidates) - set(installable)
+        candidates_set = set(candidates)
+        unknown_items = candidates_set.difference(installable)
         if unknown_items:
             error = f'The following items are not recognized: {" ".join(unknown_items)}'
             raise ValueError(error)
-        return [item for item in installable if item in candidates]
+        return [item for item in installable if item in candidates_set]
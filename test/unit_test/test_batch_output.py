@@ -0,0 +1,46 @@
+"""Unit tests for splitting the output of batched remote commands."""
+from rpi_remote_tools.batch_output import split_batch_output
+
+STATUS_FAILED = 1
+STATUS_EXIT = 3
+
+
+def test_split_batch_output() -> None:
+    """Test splitting output of commands with a trailing newline."""
+    stdout = 'one\n__RPI_BATCH_0__=0\ntwo\nlines\n__RPI_BATCH_1__=0\n'
+    stderr = '__RPI_BATCH_0__\nwarning\n__RPI_BATCH_1__\n'
+    assert split_batch_output(stdout, stderr, 2, 0) == [
+        (0, 'one\n', ''),
+        (0, 'two\nlines\n', 'warning\n'),
+    ]
+
+
+def test_split_batch_output_no_trailing_newline() -> None:
+    """Test splitting output of commands not ending their output with a newline."""
+    stdout = 'one__RPI_BATCH_0__=0\n__RPI_BATCH_1__=0\n'
+    stderr = 'error__RPI_BATCH_0__\n__RPI_BATCH_1__\n'
+    assert split_batch_output(stdout, stderr, 2, 0) == [
+        (0, 'one', 'error'),
+        (0, '', ''),
+    ]
+
+
+def test_split_batch_output_failed_command() -> None:
+    """Test that a failing command gets its exit status, and the commands after it are run."""
+    stdout = '__RPI_BATCH_0__=1\nok\n__RPI_BATCH_1__=0\n'
+    stderr = 'no such file\n__RPI_BATCH_0__\n__RPI_BATCH_1__\n'
+    assert split_batch_output(stdout, stderr, 2, 0) == [
+        (STATUS_FAILED, '', 'no such file\n'),
+        (0, 'ok\n', ''),
+    ]
+
+
+def test_split_batch_output_shell_ended() -> None:
+    """Test that a command ending the shell gets the channel status, and the commands after it are not run."""
+    stdout = 'one\n__RPI_BATCH_0__=0\nbye\n'
+    stderr = '__RPI_BATCH_0__\n'
+    assert split_batch_output(stdout, stderr, 3, STATUS_EXIT) == [
+        (0, 'one\n', ''),
+        (STATUS_EXIT, 'bye\n', ''),
+        (None, '', ''),
+    ]